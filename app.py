@@ -1,338 +1,582 @@
-#!/usr/bin/env python3
-"""
-Lab Image Batcher — 实验室显微/蛋白/细胞图片批处理与排版小应用（Streamlit）
-
-功能：
-1) 批量统一尺寸（按最长边/短边/指定宽高，支持等比、禁止放大、插值算法选择）。
-2) 批量补边（pad）或裁剪（crop），生成统一画布大小，背景可选（白/黑/自定义）。
-3) 批量重命名与导出（ZIP）。
-4) 生成排版拼图（contact sheet/蒙太奇）：按列数或行列指定，间距、边距、画布尺寸（像素或A4/Letter @DPI），文件名字幕可选。
-5) 元数据表（CSV）：原始尺寸、目标尺寸、缩放比例、输出文件名。
-6) 可选：将每张图导出到 PPTX（一页一图，标题=文件名，可选居中与标注尺寸）。
-
-运行：
-    pip install streamlit pillow numpy python-pptx
-    streamlit run app.py
-
-文件名：建议保存为 app.py
-
-注意：
-- 显微图的尺度条：本工具只做像素层面的缩放。如果需要保持物理尺度，请使用“禁止放大”与“等比缩放”，并在拼图时关闭再次缩放。
-- TIFF 支持：Pillow 对部分多通道/多页 tiff 支持有限，此处取第一页；如需拓展可自行修改。
-"""
-
-from __future__ import annotations
-import io
-import math
-import zipfile
-from dataclasses import dataclass
-from typing import List, Tuple, Optional
-
-import numpy as np
-from PIL import Image, ImageOps, ImageDraw, ImageFont
-import streamlit as st
-
-try:
-    from pptx import Presentation
-    from pptx.util import Inches, Pt
-    PPTX_AVAILABLE = True
-except Exception:
-    PPTX_AVAILABLE = False
-
-# ---------------------------- 工具函数 ----------------------------
-INTERP_MAP = {
-    "最近邻 (Nearest)": Image.NEAREST,
-    "双线性 (Bilinear)": Image.BILINEAR,
-    "双三次 (Bicubic)": Image.BICUBIC,
-    "Lanczos (高质量)": Image.LANCZOS,
-}
-
-DEFAULT_FONT = None  # 让 Pillow 使用默认字体；如需中文字体，可改为本地 .ttf 路径
-
-
-def load_image(file) -> Image.Image:
-    img = Image.open(file)
-    if getattr(img, "n_frames", 1) > 1:
-        img.seek(0)
-    return img.convert("RGB")
-
-
-def parse_size(text: str) -> Tuple[int, int]:
-    """解析类似 "1024x768" 的输入为 (w,h)。"""
-    parts = text.lower().replace("×", "x").split("x")
-    if len(parts) != 2:
-        raise ValueError("输入格式应为 宽x高，例如 1024x768")
-    w, h = int(parts[0].strip()), int(parts[1].strip())
-    if w <= 0 or h <= 0:
-        raise ValueError("宽高需要是正整数")
-    return w, h
-
-
-def pad_to_size(img: Image.Image, target_size: Tuple[int, int], color=(255, 255, 255)) -> Image.Image:
-    tw, th = target_size
-    return ImageOps.pad(img, target_size, color=color, centering=(0.5, 0.5)) if False else ImageOps.expand(
-        ImageOps.fit(img, (min(img.width, tw), min(img.height, th)), method=Image.NEAREST, centering=(0.5, 0.5)),
-        border=(max(0, (tw - min(img.width, tw)) // 2), max(0, (th - min(img.height, th)) // 2)), fill=color
-    )
-
-
-def resize_by_long_or_short(img: Image.Image, target: int, mode: str, keep_ratio: bool, no_upscale: bool, interp) -> Image.Image:
-    w, h = img.size
-    if keep_ratio:
-        if mode == "最长边":
-            scale = target / max(w, h)
-        else:
-            scale = target / min(w, h)
-        if no_upscale and scale > 1.0:
-            return img
-        nw, nh = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
-    else:
-        if mode == "最长边":
-            if w >= h:
-                nw, nh = target, h
-            else:
-                nw, nh = w, target
-        else:  # 短边
-            if w <= h:
-                nw, nh = target, h
-            else:
-                nw, nh = w, target
-        if no_upscale:
-            nw, nh = min(nw, w), min(nh, h)
-    return img.resize((nw, nh), interp)
-
-
-def resize_to_box(img: Image.Image, tw: int, th: int, fit_mode: str, color, interp, no_upscale: bool) -> Image.Image:
-    w, h = img.size
-    if fit_mode == "等比缩放，补边":
-        scale = min(tw / w, th / h)
-        if no_upscale:
-            scale = min(1.0, scale)
-        nw, nh = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
-        img2 = img.resize((nw, nh), interp)
-        canvas = Image.new("RGB", (tw, th), color)
-        canvas.paste(img2, ((tw - nw) // 2, (th - nh) // 2))
-        return canvas
-    elif fit_mode == "等比填满，居中裁剪":
-        scale = max(tw / w, th / h)
-        if no_upscale:
-            scale = min(1.0, scale)
-        nw, nh = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
-        img2 = img.resize((nw, nh), interp)
-        left = max(0, (nw - tw) // 2)
-        top = max(0, (nh - th) // 2)
-        return img2.crop((left, top, left + tw, top + th))
-    else:  # 直接拉伸
-        if no_upscale:
-            tw, th = min(tw, w), min(th, h)
-        return img.resize((tw, th), interp)
-
-
-def draw_caption(img: Image.Image, text: str, font_size: int, color=(0, 0, 0), bg: Optional[Tuple[int,int,int]] = None, pad: int = 6) -> Image.Image:
-    if not text:
-        return img
-    try:
-        font = ImageFont.truetype(DEFAULT_FONT, font_size) if DEFAULT_FONT else ImageFont.load_default()
-    except Exception:
-        font = ImageFont.load_default()
-    draw = ImageDraw.Draw(img)
-    tw, th = draw.textbbox((0, 0), text, font=font)[2:]
-    W, H = img.size
-    cap_h = th + pad * 2
-    canvas = Image.new("RGB", (W, H + cap_h), (255, 255, 255) if bg is None else bg)
-    canvas.paste(img, (0, 0))
-    draw = ImageDraw.Draw(canvas)
-    tx = (W - tw) // 2
-    ty = H + pad
-    draw.text((tx, ty), text, fill=color, font=font)
-    return canvas
-
-
-@dataclass
-class ProcessedImage:
-    name: str
-    orig_size: Tuple[int, int]
-    out_img: Image.Image
-    out_size: Tuple[int, int]
-    scale: float
-
-
-# ---------------------------- Streamlit UI ----------------------------
-st.set_page_config(page_title="Lab Image Batcher", layout="wide")
-st.title("🧪 Lab Image Batcher｜显微/蛋白/细胞图 批量处理与排版")
-
-with st.sidebar:
-    st.header("① 导入图片")
-    files = st.file_uploader("选择图片（支持多选：JPG/PNG/TIF/TIFF/BMP）", type=["jpg","jpeg","png","tif","tiff","bmp"], accept_multiple_files=True)
-    st.caption("注：TIFF 仅取第一页；所有图片将转为 RGB。")
-
-    st.header("② 尺寸与缩放")
-    mode = st.selectbox("方式", ["按最长/短边", "指定画布 (宽x高)"])
-    keep_ratio = True
-    no_upscale = st.checkbox("禁止放大", value=True)
-    interp_name = st.selectbox("插值算法", list(INTERP_MAP.keys()), index=3)
-    interp = INTERP_MAP[interp_name]
-
-    pad_bg = st.color_picker("补边/画布背景色", value="#FFFFFF")
-    bg_rgb = tuple(int(pad_bg.lstrip('#')[i:i+2], 16) for i in (0,2,4))
-
-    if mode == "按最长/短边":
-        ls_mode = st.radio("基准边", ["最长边", "短边"], horizontal=True)
-        target_px = st.number_input("目标像素", min_value=1, value=1024)
-    else:
-        box_str = st.text_input("目标画布，例如 1024x768", value="1024x768")
-        fit_mode = st.selectbox("适配方式", ["等比缩放，补边", "等比填满，居中裁剪", "不保持比例，直接拉伸"])
-        try:
-            tw, th = parse_size(box_str)
-        except Exception as e:
-            st.error(str(e))
-            tw, th = 1024, 768
-
-    st.header("③ 拼图/排版")
-    make_contact = st.checkbox("生成拼图 (contact sheet)", value=True)
-    cols = st.number_input("每行列数", min_value=1, value=4)
-    grid_gap = st.number_input("格子间距 (px)", min_value=0, value=12)
-    margin = st.number_input("画布边距 (px)", min_value=0, value=24)
-    show_caption = st.checkbox("添加文件名字幕", value=False)
-    caption_font = st.number_input("字幕字号", min_value=6, value=14)
-
-    sheet_size_mode = st.radio("画布尺寸", ["自动按网格", "自定义像素", "A4/Letter+DPI"], index=0)
-    if sheet_size_mode == "自定义像素":
-        sheet_wh = st.text_input("画布宽x高 (px)", value="2480x3508")
-        try:
-            sheet_w, sheet_h = parse_size(sheet_wh)
-        except Exception:
-            sheet_w, sheet_h = 2480, 3508
-    elif sheet_size_mode == "A4/Letter+DPI":
-        paper = st.selectbox("纸张", ["A4", "Letter"])
-        dpi = st.number_input("DPI", min_value=72, value=300)
-        if paper == "A4":
-            sheet_w, sheet_h = int(8.27 * dpi), int(11.69 * dpi)  # 竖向
-        else:
-            sheet_w, sheet_h = int(8.5 * dpi), int(11 * dpi)
-    else:
-        sheet_w, sheet_h = None, None
-
-    st.header("④ 导出")
-    do_zip = st.checkbox("导出 ZIP (单张处理后)", value=True)
-    do_csv = st.checkbox("导出 CSV 元数据", value=True)
-    do_pptx = st.checkbox("导出 PPTX (一页一图)", value=False and PPTX_AVAILABLE)
-    if do_pptx and not PPTX_AVAILABLE:
-        st.warning("未安装 python-pptx，无法导出 PPTX。请先 pip install python-pptx")
-
-# ---------------------------- 处理逻辑 ----------------------------
-processed: List[ProcessedImage] = []
-
-if files:
-    for f in files:
-        try:
-            img = load_image(f)
-        except Exception as e:
-            st.error(f"读取失败：{f.name} — {e}")
-            continue
-        orig = img.size
-        if mode == "按最长/短边":
-            out = resize_by_long_or_short(img, target_px, ls_mode, keep_ratio=True, no_upscale=no_upscale, interp=interp)
-        else:
-            out = resize_to_box(img, tw, th, fit_mode, bg_rgb, interp, no_upscale=no_upscale)
-        processed.append(ProcessedImage(name=f.name, orig_size=orig, out_img=out, out_size=out.size, scale=min(out.size[0]/orig[0], out.size[1]/orig[1])))
-
-    st.success(f"已处理 {len(processed)} 张图像")
-
-    # 预览
-    st.subheader("预览")
-    preview_cols = st.columns(4)
-    for i, item in enumerate(processed[:8]):
-        with preview_cols[i % 4]:
-            st.image(item.out_img, caption=f"{item.name} → {item.out_size[0]}x{item.out_size[1]}", use_column_width=True)
-
-    # ---------------- ZIP 导出 ----------------
-    if do_zip:
-        zip_buf = io.BytesIO()
-        with zipfile.ZipFile(zip_buf, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-            for idx, item in enumerate(processed, 1):
-                base = item.name.rsplit('.', 1)[0]
-                out_name = f"{idx:03d}_{base}.jpg"
-                img_bytes = io.BytesIO()
-                item.out_img.save(img_bytes, format="JPEG", quality=95)
-                zf.writestr(out_name, img_bytes.getvalue())
-        zip_buf.seek(0)
-        st.download_button("⬇️ 下载处理后的图片 (ZIP)", data=zip_buf, file_name="processed_images.zip", mime="application/zip")
-
-    # ---------------- CSV 元数据 ----------------
-    if do_csv:
-        import csv
-        csv_buf = io.StringIO()
-        writer = csv.writer(csv_buf)
-        writer.writerow(["filename", "orig_w", "orig_h", "out_w", "out_h", "scale"])
-        for item in processed:
-            writer.writerow([item.name, item.orig_size[0], item.orig_size[1], item.out_size[0], item.out_size[1], f"{item.scale:.4f}"])
-        st.download_button("⬇️ 下载元数据 (CSV)", data=csv_buf.getvalue().encode("utf-8-sig"), file_name="image_metadata.csv", mime="text/csv")
-
-    # ---------------- PPTX 导出 ----------------
-    if do_pptx and PPTX_AVAILABLE:
-        prs = Presentation()
-        blank = prs.slide_layouts[6]
-        for item in processed:
-            slide = prs.slides.add_slide(blank)
-            # 以 10x7.5 英寸内容区估算（默认宽 13.333" 高 7.5"，此处简单铺满高）
-            pic_stream = io.BytesIO()
-            item.out_img.save(pic_stream, format="PNG")
-            pic_stream.seek(0)
-            slide.shapes.add_picture(pic_stream, Inches(1), Inches(1), width=Inches(8))
-        pptx_buf = io.BytesIO()
-        prs.save(pptx_buf)
-        pptx_buf.seek(0)
-        st.download_button("⬇️ 下载 PPTX", data=pptx_buf, file_name="images.pptx", mime="application/vnd.openxmlformats-officedocument.presentationml.presentation")
-
-    # ---------------- 拼图/排版 ----------------
-    if make_contact:
-        # 先可选地给每张图加字幕
-        imgs_for_grid = []
-        for item in processed:
-            im = item.out_img
-            if show_caption:
-                im = draw_caption(im, item.name, caption_font, color=(0,0,0), bg=(255,255,255))
-            imgs_for_grid.append(im)
-
-        # 计算格子尺寸（使用当前处理后图片的最大宽/高）
-        cell_w = max(im.width for im in imgs_for_grid)
-        cell_h = max(im.height for im in imgs_for_grid)
-
-        if sheet_w is None or sheet_h is None:  # 自动根据列数排版
-            rows = math.ceil(len(imgs_for_grid) / cols)
-            W = margin*2 + cols*cell_w + (cols-1)*grid_gap
-            H = margin*2 + rows*cell_h + (rows-1)*grid_gap
-        else:
-            W, H = sheet_w, sheet_h
-            # 如果自定义画布过小，提示
-            minW = margin*2 + cols*cell_w + (cols-1)*grid_gap
-            rows = max(1, math.ceil((len(imgs_for_grid))/cols))
-            minH = margin*2 + rows*cell_h + (rows-1)*grid_gap
-            if W < minW or H < minH:
-                st.warning("自定义画布可能过小，部分图片会被截断或超出画布。")
-
-        sheet = Image.new("RGB", (W, H), bg_rgb)
-
-        # 布局粘贴
-        for i, im in enumerate(imgs_for_grid):
-            r = i // cols
-            c = i % cols
-            x = margin + c*(cell_w + grid_gap)
-            y = margin + r*(cell_h + grid_gap)
-            # 如果图片比 cell 小，则居中；否则左上对齐粘贴（已统一尺寸的通常不会溢出）
-            ox = x + (cell_w - im.width)//2
-            oy = y + (cell_h - im.height)//2
-            if ox < 0 or oy < 0:
-                ox, oy = x, y
-            sheet.paste(im, (ox, oy))
-
-        # 预览与导出
-        st.image(sheet, caption=f"拼图预览：{W}x{H}", use_column_width=True)
-        out_png = io.BytesIO()
-        sheet.save(out_png, format="PNG")
-        out_png.seek(0)
-        st.download_button("⬇️ 下载拼图 (PNG)", data=out_png, file_name="contact_sheet.png", mime="image/png")
-
-else:
-    st.info("请在左侧选择要处理的图片。")
+#!/usr/bin/env python3
+"""
+Lab Image Batcher — 实验室显微/蛋白/细胞图片批处理与排版小应用（Streamlit）
+
+功能：
+1) 批量统一尺寸（按最长边/短边/指定宽高，支持等比、禁止放大、插值算法选择）。
+2) 批量补边（pad）或裁剪（crop），生成统一画布大小，背景可选（白/黑/自定义）。
+3) 批量重命名与导出（ZIP）。
+4) 生成排版拼图（contact sheet/蒙太奇）：按列数或行列指定，间距、边距、画布尺寸（像素或A4/Letter @DPI），文件名字幕可选。
+5) 元数据表（CSV）：原始尺寸、目标尺寸、缩放比例、输出文件名。
+6) 可选：将每张图导出到 PPTX（一页一图，标题=文件名，可选居中与标注尺寸）。
+
+运行：
+    pip install streamlit pillow numpy opencv-python-headless python-pptx
+    streamlit run app.py
+
+文件名：建议保存为 app.py
+
+注意：
+- 显微图的尺度条：本工具只做像素层面的缩放。如果需要保持物理尺度，请使用“禁止放大”与“等比缩放”，并在拼图时关闭再次缩放。
+- TIFF 支持：Pillow 对部分多通道/多页 tiff 支持有限，此处取第一页；如需拓展可自行修改。
+- 加速：缩放核心走 OpenCV；解码/编码仍由 Pillow 负责，可选装二进制兼容的
+  Pillow-SIMD 分支（pip uninstall pillow && pip install pillow-simd，AVX2 机器可加
+  C_INCLUDE_PATH 等构建参数）进一步提速 JPEG 编解码。启动时会在控制台提示
+  libjpeg-turbo 是否启用。
+"""
+
+from __future__ import annotations
+import functools
+import hashlib
+import io
+import math
+import os
+import string
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import List, Tuple, Optional
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+import streamlit as st
+
+Image.MAX_IMAGE_PIXELS = None  # 显微大图常超过 Pillow 默认的解压炸弹阈值
+
+try:
+    from PIL import features as _pil_features
+    if not _pil_features.check_feature("libjpeg_turbo"):
+        print("Lab Image Batcher: Pillow 未启用 libjpeg-turbo，JPEG 编解码会慢一些（可考虑 pillow-simd）。")
+except Exception:
+    pass
+
+try:
+    from pptx import Presentation
+    from pptx.util import Inches, Pt
+    PPTX_AVAILABLE = True
+except Exception:
+    PPTX_AVAILABLE = False
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except Exception:
+    NUMBA_AVAILABLE = False
+
+try:
+    CUDA_AVAILABLE = cv2.cuda.getCudaEnabledDeviceCount() > 0
+except Exception:
+    CUDA_AVAILABLE = False
+
+# ---------------------------- 工具函数 ----------------------------
+# 数值核心用 OpenCV：cv2.resize 的重采样器带 SIMD 且多线程，批量缩放比 PIL 快很多。
+# 图片在 load_image 时一次性转为 ndarray，只在保存/预览边界转回 PIL。
+INTERP_MAP = {
+    "最近邻 (Nearest)": cv2.INTER_NEAREST,
+    "双线性 (Bilinear)": cv2.INTER_LINEAR,
+    "双三次 (Bicubic)": cv2.INTER_CUBIC,
+    "Lanczos (高质量)": cv2.INTER_LANCZOS4,
+}
+
+DEFAULT_FONT = None  # 让 Pillow 使用默认字体；如需中文字体，可改为本地 .ttf 路径
+
+
+def _to_ndarray(img: Image.Image) -> np.ndarray:
+    """PIL → RGB uint8 ndarray（解码后只转换这一次）。"""
+    return np.asarray(img)
+
+
+def load_image(file, target: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """解码为 RGB ndarray，返回 (数组, 原始尺寸)。
+
+    给定 target 且输入为 JPEG 时，用 draft() 让 libjpeg 在 Huffman/IDCT 阶段
+    就按 1/2、1/4、1/8 降采样解码（结果保证不小于 target，后续缩放语义不变），
+    重度缩小时解码提速可达一个数量级；TIFF/PNG 等格式 draft 是 no-op。
+    原始尺寸取自 draft 之前的文件头，保证元数据不受影响。"""
+    img = Image.open(file)
+    if getattr(img, "n_frames", 1) > 1:
+        img.seek(0)
+    orig_size = img.size
+    if target is not None and img.format == "JPEG":
+        img.draft("RGB", target)
+    return _to_ndarray(img.convert("RGB")), orig_size
+
+
+class LazyImage:
+    """按需解码的上传文件包装：持有原始字节，首次访问 .arr 时才解码为 RGB ndarray，
+    之后复用。跨 rerun 由 st.cache_resource 持有，同一文件同一 draft 目标最多解码一次。"""
+    __slots__ = ("_bytes", "_target", "_arr", "_orig_size")
+
+    def __init__(self, raw: bytes, target: Optional[Tuple[int, int]] = None):
+        self._bytes = raw
+        self._target = target
+        self._arr: Optional[np.ndarray] = None
+        self._orig_size: Optional[Tuple[int, int]] = None
+
+    @property
+    def arr(self) -> np.ndarray:
+        if self._arr is None:
+            self._arr, self._orig_size = load_image(io.BytesIO(self._bytes), self._target)
+        return self._arr
+
+    @property
+    def orig_size(self) -> Tuple[int, int]:
+        self.arr  # 确保已解码
+        return self._orig_size
+
+
+@st.cache_resource(max_entries=256)
+def _lazy_image(key: str, target: Optional[Tuple[int, int]], _raw: bytes) -> LazyImage:
+    return LazyImage(_raw, target)
+
+
+@functools.lru_cache(maxsize=None)
+def _hex_to_rgb(h: str) -> Tuple[int, int, int]:
+    """"#RRGGBB" → (r, g, b)。每次 rerun 都会调用，缓存 + bytes.fromhex 走 C 路径。"""
+    return tuple(bytes.fromhex(h.lstrip('#')))
+
+
+@functools.lru_cache(maxsize=None)
+def parse_size(text: str) -> Tuple[int, int]:
+    """解析类似 "1024x768" 的输入为 (w,h)。结果按输入串缓存，rerun 不重复解析。"""
+    parts = text.lower().replace("×", "x").split("x")
+    if len(parts) != 2:
+        raise ValueError("输入格式应为 宽x高，例如 1024x768")
+    w, h = int(parts[0].strip()), int(parts[1].strip())
+    if w <= 0 or h <= 0:
+        raise ValueError("宽高需要是正整数")
+    return w, h
+
+
+def pad_to_size(arr: np.ndarray, target_size: Tuple[int, int], color=(255, 255, 255)) -> np.ndarray:
+    """居中补边/裁剪到目标画布，不做任何重采样。
+    补边走 cv2.copyMakeBorder（SIMD 化的常量边填充），超出画布的先居中切片。"""
+    tw, th = target_size
+    h, w = arr.shape[:2]
+    if w > tw or h > th:
+        sy, sx = max(0, (h - th) // 2), max(0, (w - tw) // 2)
+        arr = arr[sy:sy + min(h, th), sx:sx + min(w, tw)]
+        h, w = arr.shape[:2]
+    t = (th - h) // 2
+    l = (tw - w) // 2
+    return cv2.copyMakeBorder(arr, t, th - h - t, l, tw - w - l, cv2.BORDER_CONSTANT, value=color)
+
+
+def _scaled_size(w: int, h: int, scale: float) -> Tuple[int, int]:
+    """(w,h)×scale → 目标尺寸，四舍五入且至少 1 像素；一处 np.rint 取代散落的 int(round())。"""
+    nw, nh = np.maximum(1, np.rint(np.array((w, h), dtype=np.float64) * scale)).astype(np.int64)
+    return int(nw), int(nh)
+
+
+def _cuda_resize(arr: np.ndarray, nw: int, nh: int, interp) -> np.ndarray:
+    """GPU 缩放（CUDA 版 OpenCV 才有）。cv2.cuda.resize 不支持 LANCZOS4，降级为 CUBIC。"""
+    if interp == cv2.INTER_LANCZOS4:
+        interp = cv2.INTER_CUBIC
+    gpu = cv2.cuda_GpuMat()
+    gpu.upload(arr)
+    return cv2.cuda.resize(gpu, (nw, nh), interpolation=interp).download()
+
+
+def _resize(arr: np.ndarray, nw: int, nh: int, interp) -> np.ndarray:
+    """缩放到 (nw, nh)。重度缩小（≤1/2）时先用 INTER_AREA 盒滤波降到 2 倍目标，
+    再用所选插值收尾到精确尺寸——昂贵的重采样核只处理 1/4 以下的像素量，
+    且盒滤波预降比直接 Lanczos 大步长抗锯齿更好。有 CUDA 设备时整个缩放放到 GPU。"""
+    if CUDA_AVAILABLE:
+        return _cuda_resize(arr, nw, nh, interp)
+    h, w = arr.shape[:2]
+    if nw * 2 <= w and nh * 2 <= h and interp != cv2.INTER_NEAREST:
+        arr = cv2.resize(arr, (nw * 2, nh * 2), interpolation=cv2.INTER_AREA)
+    return cv2.resize(arr, (nw, nh), interpolation=interp)
+
+
+def resize_by_long_or_short(arr: np.ndarray, target: int, mode: str, keep_ratio: bool, no_upscale: bool, interp) -> np.ndarray:
+    h, w = arr.shape[:2]
+    if keep_ratio:
+        if mode == "最长边":
+            scale = target / max(w, h)
+        else:
+            scale = target / min(w, h)
+        if no_upscale and scale > 1.0:
+            return arr
+        nw, nh = _scaled_size(w, h, scale)
+    else:
+        if mode == "最长边":
+            if w >= h:
+                nw, nh = target, h
+            else:
+                nw, nh = w, target
+        else:  # 短边
+            if w <= h:
+                nw, nh = target, h
+            else:
+                nw, nh = w, target
+        if no_upscale:
+            nw, nh = min(nw, w), min(nh, h)
+    return _resize(arr, nw, nh, interp)
+
+
+def resize_to_box(arr: np.ndarray, tw: int, th: int, fit_mode: str, color, interp, no_upscale: bool) -> np.ndarray:
+    h, w = arr.shape[:2]
+    if fit_mode == "等比缩放，补边":
+        scale = min(tw / w, th / h)
+        if no_upscale:
+            scale = min(1.0, scale)
+        nw, nh = _scaled_size(w, h, scale)
+        resized = _resize(arr, nw, nh, interp)
+        canvas = np.full((th, tw, 3), color, dtype=np.uint8)
+        x0, y0 = (tw - nw) // 2, (th - nh) // 2
+        canvas[y0:y0 + nh, x0:x0 + nw] = resized
+        return canvas
+    elif fit_mode == "等比填满，居中裁剪":
+        scale = max(tw / w, th / h)
+        if no_upscale:
+            scale = min(1.0, scale)
+        nw, nh = _scaled_size(w, h, scale)
+        resized = _resize(arr, nw, nh, interp)
+        left = max(0, (nw - tw) // 2)
+        top = max(0, (nh - th) // 2)
+        return resized[top:top + min(th, nh), left:left + min(tw, nw)]
+    else:  # 直接拉伸
+        if no_upscale:
+            tw, th = min(tw, w), min(th, h)
+        return _resize(arr, tw, th, interp)
+
+
+@st.cache_resource
+def _load_font(font_size: int):
+    """字体对象跨 rerun 复用，避免每张图重新加载。"""
+    try:
+        return ImageFont.truetype(DEFAULT_FONT, font_size) if DEFAULT_FONT else ImageFont.load_default()
+    except Exception:
+        return ImageFont.load_default()
+
+
+CAPTION_PAD = 6  # 字幕条上下留白 (px)
+
+
+def _caption_height(font_size: int) -> int:
+    """字幕条高度，对同一字号固定，保证所有格子同形状。"""
+    font = _load_font(font_size)
+    return font.getbbox("Hg")[3] + CAPTION_PAD * 2
+
+
+@functools.lru_cache(maxsize=16)
+def _glyph_atlas(font_size: int) -> dict:
+    """每个字号只经 FreeType 栅格化一次 ASCII 字形，存为 {char: (mask, advance)}。
+    之后的字幕直接用 NumPy 切片拼接，热路径不再碰字体引擎。"""
+    font = _load_font(font_size)
+    glyph_h = font.getbbox("Hg")[3]
+    atlas = {}
+    for ch in string.printable:
+        if ch in "\t\n\r\v\f":
+            continue
+        try:
+            adv = max(1, int(math.ceil(font.getlength(ch))))
+        except Exception:
+            adv = max(1, font.getbbox(ch)[2])
+        g = Image.new("L", (adv, glyph_h), 0)
+        ImageDraw.Draw(g).text((0, 0), ch, fill=255, font=font)
+        atlas[ch] = (np.asarray(g), adv)
+    return atlas
+
+
+def _blit_caption(strip: np.ndarray, text: str, font_size: int, color=(0, 0, 0)) -> None:
+    """把字幕写入字幕条（原地）。ASCII 走字形表；含中文等非 ASCII 时退回 FreeType。"""
+    atlas = _glyph_atlas(font_size)
+    if all(ch in atlas for ch in text):
+        total_w = sum(atlas[ch][1] for ch in text)
+        x = max(0, (strip.shape[1] - total_w) // 2)
+        y = CAPTION_PAD
+        for ch in text:
+            mask, adv = atlas[ch]
+            gh, gw = mask.shape
+            gw = min(gw, strip.shape[1] - x)
+            if gw <= 0:
+                break
+            region = strip[y:y + gh, x:x + gw]
+            region[mask[:region.shape[0], :gw] > 0] = color
+            x += adv
+    else:
+        img = Image.fromarray(strip)
+        draw = ImageDraw.Draw(img)
+        font = _load_font(font_size)
+        text_w = draw.textbbox((0, 0), text, font=font)[2]
+        draw.text((max(0, (strip.shape[1] - text_w) // 2), CAPTION_PAD), text, fill=color, font=font)
+        strip[:] = np.asarray(img)
+
+
+def _render_cell(src_arr: np.ndarray, cell_w: int, cell_h: int, cap_h: int, caption: str, font_size: int, bg) -> np.ndarray:
+    """一次分配渲染一个格子：图像居中补边 + 可选底部字幕条。
+
+    取代原来的 draw_caption（整图再分配一次画布）+ 逐格补边两步，把补边和
+    字幕写进同一块输出缓冲，每格只剩一次全幅拷贝。"""
+    out = np.empty((cell_h + cap_h, cell_w, 3), dtype=np.uint8)
+    out[:cell_h] = bg
+    h, w = src_arr.shape[:2]
+    y0 = max(0, (cell_h - h) // 2)
+    x0 = max(0, (cell_w - w) // 2)
+    out[y0:y0 + h, x0:x0 + w] = src_arr
+    if cap_h:
+        out[cell_h:] = (255, 255, 255)
+        _blit_caption(out[cell_h:], caption, font_size)
+    return out
+
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def _blit_grid(sheet: np.ndarray, cells: np.ndarray, positions: np.ndarray) -> None:
+        ch, cw = cells.shape[1], cells.shape[2]
+        for i in prange(cells.shape[0]):
+            y = positions[i, 0]
+            x = positions[i, 1]
+            sheet[y:y + ch, x:x + cw] = cells[i]
+else:
+    def _blit_grid(sheet: np.ndarray, cells: np.ndarray, positions: np.ndarray) -> None:
+        ch, cw = cells.shape[1], cells.shape[2]
+        for i in range(cells.shape[0]):
+            y, x = positions[i]
+            sheet[y:y + ch, x:x + cw] = cells[i]
+
+
+@dataclass
+class ProcessedImage:
+    name: str
+    orig_size: Tuple[int, int]
+    out_img: np.ndarray  # RGB uint8 (H, W, 3)
+    out_size: Tuple[int, int]
+    scale: float
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _cached_process(key: str, name: str, params: tuple, _lazy: LazyImage) -> ProcessedImage:
+    """缩放一张图。以内容哈希 key + 尺寸参数为缓存键，widget 交互触发的
+    rerun 直接命中缓存；_lazy 带下划线前缀，streamlit 不会哈希它，
+    解码结果在 LazyImage 里复用——改尺寸参数只重新缩放、不重新解码。"""
+    arr = _lazy.arr
+    orig = _lazy.orig_size
+    if params[0] == "按最长/短边":
+        _, ls_mode, target_px, no_upscale, interp = params
+        out = resize_by_long_or_short(arr, target_px, ls_mode, keep_ratio=True, no_upscale=no_upscale, interp=interp)
+    else:
+        _, bw, bh, fit_mode, bg, no_upscale, interp = params
+        out = resize_to_box(arr, bw, bh, fit_mode, bg, interp, no_upscale=no_upscale)
+    out_size = (out.shape[1], out.shape[0])
+    return ProcessedImage(name=name, orig_size=orig, out_img=out, out_size=out_size, scale=min(out_size[0]/orig[0], out_size[1]/orig[1]))
+
+
+# ---------------------------- Streamlit UI ----------------------------
+st.set_page_config(page_title="Lab Image Batcher", layout="wide")
+st.title("🧪 Lab Image Batcher｜显微/蛋白/细胞图 批量处理与排版")
+
+with st.sidebar:
+    st.header("① 导入图片")
+    files = st.file_uploader("选择图片（支持多选：JPG/PNG/TIF/TIFF/BMP）", type=["jpg","jpeg","png","tif","tiff","bmp"], accept_multiple_files=True)
+    st.caption("注：TIFF 仅取第一页；所有图片将转为 RGB。")
+
+    st.header("② 尺寸与缩放")
+    mode = st.selectbox("方式", ["按最长/短边", "指定画布 (宽x高)"])
+    keep_ratio = True
+    no_upscale = st.checkbox("禁止放大", value=True)
+    interp_name = st.selectbox("插值算法", list(INTERP_MAP.keys()), index=3)
+    interp = INTERP_MAP[interp_name]
+
+    pad_bg = st.color_picker("补边/画布背景色", value="#FFFFFF")
+    bg_rgb = _hex_to_rgb(pad_bg)
+
+    if mode == "按最长/短边":
+        ls_mode = st.radio("基准边", ["最长边", "短边"], horizontal=True)
+        target_px = st.number_input("目标像素", min_value=1, value=1024)
+    else:
+        box_str = st.text_input("目标画布，例如 1024x768", value="1024x768")
+        fit_mode = st.selectbox("适配方式", ["等比缩放，补边", "等比填满，居中裁剪", "不保持比例，直接拉伸"])
+        try:
+            tw, th = parse_size(box_str)
+        except Exception as e:
+            st.error(str(e))
+            tw, th = 1024, 768
+
+    st.header("③ 拼图/排版")
+    make_contact = st.checkbox("生成拼图 (contact sheet)", value=True)
+    cols = st.number_input("每行列数", min_value=1, value=4)
+    grid_gap = st.number_input("格子间距 (px)", min_value=0, value=12)
+    margin = st.number_input("画布边距 (px)", min_value=0, value=24)
+    show_caption = st.checkbox("添加文件名字幕", value=False)
+    caption_font = st.number_input("字幕字号", min_value=6, value=14)
+
+    sheet_size_mode = st.radio("画布尺寸", ["自动按网格", "自定义像素", "A4/Letter+DPI"], index=0)
+    if sheet_size_mode == "自定义像素":
+        sheet_wh = st.text_input("画布宽x高 (px)", value="2480x3508")
+        try:
+            sheet_w, sheet_h = parse_size(sheet_wh)
+        except Exception:
+            sheet_w, sheet_h = 2480, 3508
+    elif sheet_size_mode == "A4/Letter+DPI":
+        paper = st.selectbox("纸张", ["A4", "Letter"])
+        dpi = st.number_input("DPI", min_value=72, value=300)
+        if paper == "A4":
+            sheet_w, sheet_h = int(8.27 * dpi), int(11.69 * dpi)  # 竖向
+        else:
+            sheet_w, sheet_h = int(8.5 * dpi), int(11 * dpi)
+    else:
+        sheet_w, sheet_h = None, None
+
+    st.header("④ 导出")
+    do_zip = st.checkbox("导出 ZIP (单张处理后)", value=True)
+    do_csv = st.checkbox("导出 CSV 元数据", value=True)
+    do_pptx = st.checkbox("导出 PPTX (一页一图)", value=False and PPTX_AVAILABLE)
+    if do_pptx and not PPTX_AVAILABLE:
+        st.warning("未安装 python-pptx，无法导出 PPTX。请先 pip install python-pptx")
+
+# ---------------------------- 处理逻辑 ----------------------------
+processed: List[ProcessedImage] = []
+
+if files:
+    if mode == "按最长/短边":
+        size_params = (mode, ls_mode, target_px, no_upscale, interp)
+        draft_target = (target_px, target_px)
+    else:
+        size_params = (mode, tw, th, fit_mode, bg_rgb, no_upscale, interp)
+        draft_target = (tw, th)
+
+    def _process_one(f) -> ProcessedImage:
+        raw = f.getvalue()
+        key = hashlib.blake2b(raw, digest_size=16).hexdigest()
+        return _cached_process(key, f.name, size_params, _lazy_image(key, draft_target, raw))
+
+    # 解码与 cv2 缩放都会释放 GIL，线程池对批量上传接近线性加速
+    results: dict[int, ProcessedImage] = {}
+    with st.spinner("处理中..."):
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            futures = {ex.submit(_process_one, f): i for i, f in enumerate(files)}
+            for fut in as_completed(futures):
+                i = futures[fut]
+                try:
+                    results[i] = fut.result()
+                except Exception as e:
+                    st.error(f"处理失败：{files[i].name} — {e}")
+    processed = [results[i] for i in range(len(files)) if i in results]
+
+    st.success(f"已处理 {len(processed)} 张图像")
+
+    # 预览
+    st.subheader("预览")
+    preview_cols = st.columns(4)
+    PREVIEW_PX = 512
+    for i, item in enumerate(processed[:8]):
+        with preview_cols[i % 4]:
+            # 预览走 ≤512px 的 JPEG 缩略图：绕开 streamlit 默认的 PNG 编码，
+            # 也避免把全尺寸图推过本地 websocket；全尺寸数据仍用于 ZIP/PPTX
+            thumb = item.out_img
+            h, w = thumb.shape[:2]
+            if max(w, h) > PREVIEW_PX:
+                nw, nh = _scaled_size(w, h, PREVIEW_PX / max(w, h))
+                thumb = _resize(thumb, nw, nh, cv2.INTER_LINEAR)
+            buf = io.BytesIO()
+            Image.fromarray(thumb).save(buf, format="JPEG", quality=85)
+            st.image(buf.getvalue(), caption=f"{item.name} → {item.out_size[0]}x{item.out_size[1]}", use_column_width=True)
+
+    # ---------------- ZIP 导出 ----------------
+    if do_zip:
+        def _encode_entry(args) -> Tuple[str, memoryview]:
+            idx, item = args
+            base = item.name.rsplit('.', 1)[0]
+            out_name = f"{idx:03d}_{base}.jpg"
+            buf = io.BytesIO()
+            Image.fromarray(item.out_img).save(buf, format="JPEG", quality=95, optimize=False)
+            return out_name, buf.getbuffer()
+
+        # 先并行编码 JPEG，再顺序写入 zip；JPEG 本身已压缩，用 ZIP_STORED 省掉无效的 deflate
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            entries = list(ex.map(_encode_entry, enumerate(processed, 1)))
+        zip_buf = io.BytesIO()
+        with zipfile.ZipFile(zip_buf, mode="w", compression=zipfile.ZIP_STORED) as zf:
+            now = time.localtime()[:6]
+            for out_name, data in entries:
+                with zf.open(zipfile.ZipInfo(out_name, date_time=now), "w", force_zip64=True) as zfp:
+                    zfp.write(data)
+        zip_buf.seek(0)
+        st.download_button("⬇️ 下载处理后的图片 (ZIP)", data=zip_buf, file_name="processed_images.zip", mime="application/zip")
+
+    # ---------------- CSV 元数据 ----------------
+    if do_csv:
+        # 字段只有文件名和数字，直接拼字符串即可，省掉 csv 模块的逐字段扫描；
+        # 文件名统一加引号并把内部的 " 翻倍转义，utf-8-sig 带 BOM 方便 Excel 打开
+        rows = ["filename,orig_w,orig_h,out_w,out_h,scale"]
+        for item in processed:
+            name = item.name.replace('"', '""')
+            rows.append(f'"{name}",{item.orig_size[0]},{item.orig_size[1]},{item.out_size[0]},{item.out_size[1]},{item.scale:.4f}')
+        st.download_button("⬇️ 下载元数据 (CSV)", data="\n".join(rows).encode("utf-8-sig"), file_name="image_metadata.csv", mime="text/csv")
+
+    # ---------------- PPTX 导出 ----------------
+    if do_pptx and PPTX_AVAILABLE:
+        prs = Presentation()
+        blank = prs.slide_layouts[6]
+        # 按像素内容去重：重复上传的同一张图只编码一次；喂给 add_picture 相同的
+        # 字节时 python-pptx 也只嵌入一份媒体部件，各页通过关系引用共享
+        enc_cache: dict = {}
+        for item in processed:
+            slide = prs.slides.add_slide(blank)
+            # 以 10x7.5 英寸内容区估算（默认宽 13.333" 高 7.5"，此处简单铺满高）
+            key = hashlib.blake2b(item.out_img.tobytes(), digest_size=16).digest()
+            pic_stream = enc_cache.get(key)
+            if pic_stream is None:
+                pic_stream = io.BytesIO()
+                # 显微照片内容用 JPEG q=92 视觉无损，编码比 PNG 快一个数量级，文件也更小
+                Image.fromarray(item.out_img).save(pic_stream, format="JPEG", quality=92, optimize=False, progressive=False)
+                enc_cache[key] = pic_stream
+            pic_stream.seek(0)
+            slide.shapes.add_picture(pic_stream, Inches(1), Inches(1), width=Inches(8))
+        pptx_buf = io.BytesIO()
+        prs.save(pptx_buf)
+        pptx_buf.seek(0)
+        st.download_button("⬇️ 下载 PPTX", data=pptx_buf, file_name="images.pptx", mime="application/vnd.openxmlformats-officedocument.presentationml.presentation")
+
+    # ---------------- 拼图/排版 ----------------
+    if make_contact:
+        # 计算格子尺寸（使用当前处理后图片的最大宽/高；字幕条高度对固定字号一致）
+        cell_w = max(item.out_img.shape[1] for item in processed)
+        cell_h = max(item.out_img.shape[0] for item in processed)
+        cap_h = _caption_height(caption_font) if show_caption else 0
+        full_h = cell_h + cap_h
+
+        # 整数上取整（-(-n//c)）与步长只算一次
+        n = len(processed)
+        rows = -(-n // cols)
+        stride_x = cell_w + grid_gap
+        stride_y = full_h + grid_gap
+        if sheet_w is None or sheet_h is None:  # 自动根据列数排版
+            W = margin*2 + cols*stride_x - grid_gap
+            H = margin*2 + rows*stride_y - grid_gap
+        else:
+            W, H = sheet_w, sheet_h
+            # 如果自定义画布过小，提示
+            minW = margin*2 + cols*stride_x - grid_gap
+            minH = margin*2 + rows*stride_y - grid_gap
+            if W < minW or H < minH:
+                st.warning("自定义画布可能过小，超出画布的图片会被跳过。")
+
+        # 布局一次性向量化算出；每格一次分配（补边+字幕融合），统一形状后并行粘贴
+        idx = np.arange(n)
+        positions = np.empty((n, 2), dtype=np.int32)
+        positions[:, 0] = margin + (idx // cols) * stride_y
+        positions[:, 1] = margin + (idx % cols) * stride_x
+        cells = np.empty((n, full_h, cell_w, 3), dtype=np.uint8)
+        for i, item in enumerate(processed):
+            cells[i] = _render_cell(item.out_img, cell_w, cell_h, cap_h, item.name, caption_font, bg_rgb)
+        inside = (positions[:, 0] + full_h <= H) & (positions[:, 1] + cell_w <= W)
+        sheet_arr = np.empty((H, W, 3), dtype=np.uint8)
+        sheet_arr[:] = bg_rgb
+        _blit_grid(sheet_arr, cells[inside], positions[inside])
+
+        # 预览与导出（ndarray 直接交给 st.image，只在编码 PNG 时转回 PIL；
+        # compress_level=1 让大画布的 PNG 编码不成为瓶颈）
+        st.image(sheet_arr, caption=f"拼图预览：{W}x{H}", use_column_width=True)
+        out_png = io.BytesIO()
+        Image.fromarray(sheet_arr).save(out_png, format="PNG", compress_level=1)
+        out_png.seek(0)
+        st.download_button("⬇️ 下载拼图 (PNG)", data=out_png, file_name="contact_sheet.png", mime="image/png")
+
+else:
+    st.info("请在左侧选择要处理的图片。")